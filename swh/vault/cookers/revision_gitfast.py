@@ -4,19 +4,17 @@
 # See top-level LICENSE file for more information
 
 import functools
-import os
+import itertools
 import time
 import zlib
 
 from fastimport.commands import (
-    BlobCommand,
     CommitCommand,
     FileDeleteCommand,
     FileModifyCommand,
     ResetCommand,
 )
 
-from swh.model import hashutil
 from swh.model.from_disk import DentryPerms, mode_to_perms
 from swh.model.swhids import ObjectType
 from swh.model.toposort import toposort
@@ -24,6 +22,15 @@ from swh.vault.cookers.base import BaseVaultCooker
 from swh.vault.cookers.utils import revision_log
 from swh.vault.to_disk import get_filtered_file_content
 
+EMPTY_PERSON: dict = {}
+EMPTY_DATE: dict = {}
+EMPTY_TIMESTAMP: dict = {}
+
+# Size of the output buffer collecting compressed chunks before they are
+# written out; commands compress to a few bytes each, and pushing them one by
+# one to the bundle file object is mostly call overhead.
+OUTPUT_BUFFER_SIZE = 64 * 1024
+
 
 class RevisionGitfastCooker(BaseVaultCooker):
     """Cooker to create a git fast-import bundle"""
@@ -37,29 +44,41 @@ class RevisionGitfastCooker(BaseVaultCooker):
     def prepare_bundle(self):
         self.log = list(toposort(revision_log(self.storage, self.obj_id)))
         self.gzobj = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        self.buffer = bytearray()
         self.fastexport()
-        self.write(self.gzobj.flush())
+        self.buffer += self.gzobj.flush()
+        self.write(bytes(self.buffer))
+        self.buffer.clear()
+
+    def write_data(self, data):
+        """Compress a chunk of the fast-import stream, writing the compressed
+        output out only once the internal buffer is full."""
+        self.buffer += self.gzobj.compress(data)
+        if len(self.buffer) >= OUTPUT_BUFFER_SIZE:
+            self.write(bytes(self.buffer))
+            self.buffer.clear()
 
     def write_cmd(self, cmd):
-        chunk = bytes(cmd) + b"\n"
-        super().write(self.gzobj.compress(chunk))
+        self.write_data(bytes(cmd) + b"\n")
 
     def fastexport(self):
         """Generate all the git fast-import commands from a given log."""
         self.rev_by_id = {r["id"]: r for r in self.log}
-        self.obj_done = set()
         self.obj_to_mark = {}
-        self.next_available_mark = 1
+        self._next_available_mark = itertools.count(1).__next__
 
         last_progress_report = None
 
         for i, rev in enumerate(self.log, 1):
-            # Update progress if needed
-            ct = time.time()
-            if last_progress_report is None or last_progress_report + 2 <= ct:
-                last_progress_report = ct
-                pg = "Computing revision {}/{}".format(i, len(self.log))
-                self.backend.set_progress(self.BUNDLE_TYPE, self.swhid, pg)
+            # Update progress if needed; only look at the clock every 1024
+            # revisions, as a time.time() call per revision adds up on
+            # million-commit logs.
+            if last_progress_report is None or i & 1023 == 0:
+                ct = time.time()
+                if last_progress_report is None or last_progress_report + 2 <= ct:
+                    last_progress_report = ct
+                    pg = "Computing revision {}/{}".format(i, len(self.log))
+                    self.backend.set_progress(self.BUNDLE_TYPE, self.swhid, pg)
 
             # Compute the current commit
             self._compute_commit_command(rev)
@@ -69,38 +88,51 @@ class RevisionGitfastCooker(BaseVaultCooker):
 
         If the object has not yet been marked, assign a new ID and add it to
         the mark dictionary.
+
+        The mark dictionary holds one entry per object of the whole history,
+        so it is kept to a single int-valued dict with one lookup per call;
+        the ASCII representation is cheap to produce on demand.
         """
-        if obj_id not in self.obj_to_mark:
-            self.obj_to_mark[obj_id] = self.next_available_mark
-            self.next_available_mark += 1
-        return str(self.obj_to_mark[obj_id]).encode()
+        mark = self.obj_to_mark.get(obj_id)
+        if mark is None:
+            mark = self.obj_to_mark[obj_id] = self._next_available_mark()
+        return b"%d" % mark
 
     def _compute_blob_command_content(self, file_data):
         """Compute the blob command of a file entry if it has not been
         computed yet.
         """
         obj_id = file_data["sha1"]
-        if obj_id in self.obj_done:
+        # A blob gets its mark assigned when its command is emitted below, so
+        # presence in the mark dictionary means it has been written already;
+        # no separate done-set (one more entry per blob) is needed.
+        if obj_id in self.obj_to_mark:
             return
-        content = get_filtered_file_content(self.storage, file_data)
-        self.write_cmd(BlobCommand(mark=self.mark(obj_id), data=content["content"]))
-        self.obj_done.add(obj_id)
+        # get_filtered_file_content() sets the content on the entry in place,
+        # and file_data here comes from the _get_dir_ents cache: pop the
+        # content back out so blob bytes do not stay pinned in cached trees.
+        content = get_filtered_file_content(self.storage, file_data).pop("content")
+        # Emit the blob command directly: serializing a fastimport
+        # BlobCommand would concatenate the header with a full copy of the
+        # content, which doubles the memory traffic for large blobs.
+        self.write_data(
+            b"blob\nmark :" + self.mark(obj_id) + b"\ndata %d\n" % len(content)
+        )
+        self.write_data(content)
+        self.write_data(b"\n")
 
     def _author_tuple_format(self, author, date):
         # We never want to have None values here so we replace null entries
-        # by ''.
-        if author is not None:
-            author_tuple = (author.get("name") or b"", author.get("email") or b"")
-        else:
-            author_tuple = (b"", b"")
-        if date is not None:
-            date_tuple = (
-                date.get("timestamp", {}).get("seconds") or 0,
-                (date.get("offset") or 0) * 60,
-            )
-        else:
-            date_tuple = (0, 0)
-        return author_tuple + date_tuple
+        # by ''. Falling back to empty dicts keeps this a plain chain of
+        # dict lookups, as it runs twice per revision.
+        author = author or EMPTY_PERSON
+        date = date or EMPTY_DATE
+        return (
+            author.get("name") or b"",
+            author.get("email") or b"",
+            (date.get("timestamp") or EMPTY_TIMESTAMP).get("seconds") or 0,
+            (date.get("offset") or 0) * 60,
+        )
 
     def _compute_commit_command(self, rev):
         """Compute a commit command from a specific revision."""
@@ -157,62 +189,74 @@ class RevisionGitfastCooker(BaseVaultCooker):
         parent_dir = parent["directory"] if parent else None
         stack = [(b"", cur_dir, parent_dir)]
 
+        # Bind the bound method once: this loop runs for every directory of
+        # every revision of the log.
+        get_dir_ents = self._get_dir_ents
+
         while stack:
             # Retrieve the current directory and the directory of the parent
             # commit in order to compute the diff of the trees.
             root, cur_dir_id, prev_dir_id = stack.pop()
-            cur_dir = self._get_dir_ents(cur_dir_id)
-            prev_dir = self._get_dir_ents(prev_dir_id)
-
-            # Find subtrees to delete:
-            #  - Subtrees that are not in the new tree (file or directory
-            #    deleted).
-            #  - Subtrees that do not have the same type in the new tree
-            #    (file -> directory or directory -> file)
-            # After this step, every node remaining in the previous directory
-            # has the same type than the one in the current directory.
-            for fname, f in prev_dir.items():
-                if fname not in cur_dir or f["type"] != cur_dir[fname]["type"]:
-                    yield FileDeleteCommand(path=os.path.join(root, fname))
-
-            # Find subtrees to modify:
-            #  - Leaves (files) will be added or modified using `filemodify`
-            #  - Other subtrees (directories) will be added to the stack and
-            #    processed in the next iteration.
+            cur_dir = get_dir_ents(cur_dir_id)
+            prev_dir = get_dir_ents(prev_dir_id)
+
+            # Paths here are always forward-slash repo-relative bytes, so a
+            # plain concatenation is enough; os.path.join is a full Python
+            # function call per file otherwise.
+            prefix = root + b"/" if root else b""
+
+            # Compute the diff of the trees in a single pass, with one
+            # prev_dir lookup per entry of the current tree:
+            #  - entries whose type changed are deleted before being
+            #    rewritten;
+            #  - leaves (files) are added or modified using `filemodify`;
+            #  - changed subtrees (directories) are added to the stack and
+            #    processed in the next iteration;
+            #  - entries present in the previous tree only are deleted last.
             for fname, f in cur_dir.items():
-                # A file is added or modified if it was not in the tree, if its
-                # permissions changed or if its content changed.
-                if f["type"] == "file" and (
-                    fname not in prev_dir
-                    or f["sha1"] != prev_dir[fname]["sha1"]
-                    or f["perms"] != prev_dir[fname]["perms"]
-                ):
-                    # Issue a blob command for the new blobs if needed.
-                    self._compute_blob_command_content(f)
-                    yield FileModifyCommand(
-                        path=os.path.join(root, fname),
-                        mode=mode_to_perms(f["perms"]).value,
-                        dataref=(b":" + self.mark(f["sha1"])),
-                        data=None,
-                    )
+                f_prev = prev_dir.get(fname)
+                if f_prev is not None and f_prev["type"] != f["type"]:
+                    # The entry does not have the same type in the new tree
+                    # (file -> directory or directory -> file): delete it and
+                    # treat the new entry as an addition.
+                    yield FileDeleteCommand(path=prefix + fname)
+                    f_prev = None
+
+                if f["type"] == "file":
+                    # A file is added or modified if it was not in the tree,
+                    # if its permissions changed or if its content changed.
+                    if (
+                        f_prev is None
+                        or f["sha1"] != f_prev["sha1"]
+                        or f["perms"] != f_prev["perms"]
+                    ):
+                        # Issue a blob command for the new blobs if needed.
+                        self._compute_blob_command_content(f)
+                        yield FileModifyCommand(
+                            path=prefix + fname,
+                            mode=mode_to_perms(f["perms"]).value,
+                            dataref=(b":" + self.mark(f["sha1"])),
+                            data=None,
+                        )
                 # A revision is added or modified if it was not in the tree or
                 # if its target changed
-                elif f["type"] == "rev" and (
-                    fname not in prev_dir or f["target"] != prev_dir[fname]["target"]
-                ):
-                    yield FileModifyCommand(
-                        path=os.path.join(root, fname),
-                        mode=DentryPerms.revision,
-                        dataref=hashutil.hash_to_hex(f["target"]).encode(),
-                        data=None,
-                    )
+                elif f["type"] == "rev":
+                    if f_prev is None or f["target"] != f_prev["target"]:
+                        yield FileModifyCommand(
+                            path=prefix + fname,
+                            mode=DentryPerms.revision,
+                            dataref=f["target"].hex().encode(),
+                            data=None,
+                        )
                 # A directory is added or modified if it was not in the tree or
                 # if its target changed.
                 elif f["type"] == "dir":
-                    f_prev_target = None
-                    if fname in prev_dir and prev_dir[fname]["type"] == "dir":
-                        f_prev_target = prev_dir[fname]["target"]
+                    f_prev_target = f_prev["target"] if f_prev is not None else None
                     if f_prev_target is None or f["target"] != f_prev_target:
-                        stack.append(
-                            (os.path.join(root, fname), f["target"], f_prev_target)
-                        )
+                        stack.append((prefix + fname, f["target"], f_prev_target))
+
+            # Subtrees that are not in the new tree (file or directory
+            # deleted).
+            for fname in prev_dir:
+                if fname not in cur_dir:
+                    yield FileDeleteCommand(path=prefix + fname)
@@ -16,6 +16,9 @@ import swh.vault.api.server
 from swh.vault.api.server import app, check_config, get_vault, make_app_from_configfile
 from swh.vault.tests.test_backend import TEST_SWHID
 
+JSON_HEADERS = [("Content-Type", "application/json")]
+MSGPACK_HEADERS = [("Content-Type", "application/x-msgpack")]
+
 
 @pytest.fixture
 def swh_vault_server_config(swh_vault_config: Dict[str, Any]) -> Dict[str, Any]:
@@ -108,7 +111,7 @@ def test_client_cook_notfound(cli):
         data=json_dumps(
             {"bundle_type": "flat", "swhid": TEST_SWHID}, extra_encoders=ENCODERS
         ),
-        headers=[("Content-Type", "application/json")],
+        headers=JSON_HEADERS,
     )
     assert resp.status == "400 BAD REQUEST"
     content = msgpack_loads(resp.data)
@@ -122,7 +125,7 @@ def test_client_progress_notfound(cli):
         data=json_dumps(
             {"bundle_type": "flat", "swhid": TEST_SWHID}, extra_encoders=ENCODERS
         ),
-        headers=[("Content-Type", "application/json")],
+        headers=JSON_HEADERS,
     )
     assert resp.status == "400 BAD REQUEST"
     content = msgpack_loads(resp.data)
@@ -134,7 +137,7 @@ def test_client_batch_cook_invalid_type(cli):
     resp = cli.post(
         "/batch_cook",
         data=msgpack_dumps({"batch": [("foobar", [])]}),
-        headers={"Content-Type": "application/x-msgpack"},
+        headers=MSGPACK_HEADERS,
     )
     assert resp.status == "400 BAD REQUEST"
     content = msgpack_loads(resp.data)
@@ -146,7 +149,7 @@ def test_client_batch_progress_notfound(cli):
     resp = cli.post(
         "/batch_progress",
         data=msgpack_dumps({"batch_id": 1}),
-        headers={"Content-Type": "application/x-msgpack"},
+        headers=MSGPACK_HEADERS,
     )
     assert resp.status == "400 BAD REQUEST"
     content = msgpack_loads(resp.data)
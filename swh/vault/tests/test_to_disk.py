@@ -7,7 +7,11 @@ import pytest
 
 from swh.model.from_disk import DentryPerms
 from swh.model.model import Content, Directory, DirectoryEntry, SkippedContent
-from swh.vault.to_disk import DirectoryBuilder, get_filtered_file_content
+from swh.vault.to_disk import (
+    DirectoryBuilder,
+    get_filtered_file_content,
+    get_filtered_files_content,
+)
 
 
 def test_get_filtered_files_content(swh_storage):
@@ -60,6 +64,58 @@ def test_get_filtered_files_content(swh_storage):
     ]
 
 
+def test_get_filtered_files_content_batched(swh_storage):
+    content = Content.from_data(b"foo bar")
+    skipped_content = SkippedContent(
+        sha1=None,
+        sha1_git=b"c" * 20,
+        sha256=None,
+        blake2s256=None,
+        length=42,
+        status="absent",
+        reason="for some reason",
+    )
+    swh_storage.content_add([content])
+    swh_storage.skipped_content_add([skipped_content])
+
+    files_data = [
+        {
+            "status": "visible",
+            "sha1": content.sha1,
+            "sha1_git": content.sha1_git,
+            "target": content.sha1_git,
+        },
+        {
+            "status": "absent",
+            "target": skipped_content.sha1_git,
+        },
+    ]
+
+    res = list(
+        get_filtered_files_content(
+            swh_storage, files_data, objstorage=swh_storage.objstorage
+        )
+    )
+
+    assert res == [
+        {
+            "content": content.data,
+            "status": "visible",
+            "sha1": content.sha1,
+            "sha1_git": content.sha1_git,
+            "target": content.sha1_git,
+        },
+        {
+            "content": (
+                b"This content has not been retrieved in the "
+                b"Software Heritage archive due to its size."
+            ),
+            "status": "absent",
+            "target": skipped_content.sha1_git,
+        },
+    ]
+
+
 def test_get_filtered_files_content__unknown_status(swh_storage):
     content = Content.from_data(b"foo bar")
     swh_storage.content_add([content])
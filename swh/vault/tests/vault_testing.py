@@ -3,8 +3,20 @@
 # License: GNU General Public License version 3, or any later version
 # See top-level LICENSE file for more information
 
+import os
+
 from swh.model import hashutil
 
+#: Root directory for the temporary repositories and extraction directories
+#: created by the tests: tmpfs when available, so that git object writes and
+#: bundle extractions never hit the block layer, the default tempdir
+#: otherwise.
+TMP_ROOT = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+#: Copy-buffer size for extracting cooked bundles: tarfile's 16 KiB default
+#: makes extraction of multi-MiB members syscall-bound.
+TAR_BUFSIZE = 2 * 1024 * 1024
+
 
 def hash_content(content):
     """Hash the content's id (sha1).
@@ -6,8 +6,9 @@
 import collections
 import concurrent
 import os
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 
+from swh.core.utils import grouper
 from swh.model import hashutil
 from swh.model.from_disk import DentryPerms, mode_to_perms
 from swh.objstorage.interface import ObjStorageInterface, objid_from_dict
@@ -25,6 +26,12 @@ SKIPPED_MESSAGE = (
 
 HIDDEN_MESSAGE = b"This content is hidden."
 
+FALLOCATE_MIN_SIZE = 1 * 1024 * 1024
+"""Contents at least this large are preallocated with os.posix_fallocate()."""
+
+FILE_BATCH_SIZE = 1000
+"""Number of file contents per objstorage.get_batch() call."""
+
 
 def get_filtered_file_content(
     storage: StorageInterface,
@@ -39,8 +46,9 @@ def get_filtered_file_content(
         file_data: a file entry as returned by directory_ls()
 
     Returns:
-        The entry given in file_data with a new 'content' key that points to
-        the file content in bytes.
+        The entry given in file_data, with a new 'content' key that points to
+        the file content in bytes; the entry is updated in place rather than
+        copied.
 
         The contents can be replaced by a specific message to indicate that
         they could not be retrieved (either due to privacy policy or because
@@ -71,12 +79,54 @@ def get_filtered_file_content(
             f"for content {hashutil.hash_to_hex(file_data['target'])}"
         )
 
-    return {"content": content, **file_data}
+    file_data["content"] = content
+    return file_data
+
+
+def get_filtered_files_content(
+    storage: StorageInterface,
+    files_data: Iterable[Dict[str, Any]],
+    objstorage: Optional[ObjStorageInterface] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Retrieve the contents of the given file entries, in order.
+
+    Same as :func:`get_filtered_file_content` applied to each entry, except
+    that when an objstorage is given, visible contents are fetched with one
+    ``get_batch()`` call per group of ``FILE_BATCH_SIZE`` entries instead of
+    one round-trip per file.
+    """
+    if objstorage is None:
+        for file_data in files_data:
+            yield get_filtered_file_content(storage, file_data)
+        return
+
+    for batch in grouper(files_data, FILE_BATCH_SIZE):
+        batch = list(batch)
+        visible = [fd for fd in batch if fd["status"] == "visible"]
+        data = iter(objstorage.get_batch([objid_from_dict(fd) for fd in visible]))
+        for file_data in batch:
+            if file_data["status"] == "visible":
+                content = next(data)
+                if content is None:
+                    content = SKIPPED_MESSAGE
+                file_data["content"] = content
+                yield file_data
+            else:
+                yield get_filtered_file_content(storage, file_data)
 
 
 class DirectoryBuilder:
     """Reconstructs the on-disk representation of a directory in the storage."""
 
+    __slots__ = (
+        "storage",
+        "root",
+        "_root_prefix",
+        "dir_id",
+        "thread_pool_size",
+        "objstorage",
+    )
+
     def __init__(
         self,
         storage: StorageInterface,
@@ -94,6 +144,10 @@ class DirectoryBuilder:
         """
         self.storage = storage
         self.root = root
+        # Entry paths are repo-relative bytes, so target paths are built by
+        # concatenating them to this prefix; os.path.join would be a pure
+        # Python call per entry.
+        self._root_prefix = root.rstrip(b"/") + b"/"
         self.dir_id = dir_id
         self.thread_pool_size = thread_pool_size
         self.objstorage = objstorage
@@ -102,46 +156,85 @@ class DirectoryBuilder:
         """Perform the reconstruction of the directory in the given root."""
 
         def file_fetcher(file_data: Dict[str, Any]) -> None:
-            file_data = get_filtered_file_content(
-                self.storage, file_data, self.objstorage
-            )
-            path = os.path.join(self.root, file_data["path"])
+            file_data = get_filtered_file_content(self.storage, file_data)
+            file_writer(file_data)
+
+        def file_writer(file_data: Dict[str, Any]) -> None:
+            path = self._root_prefix + file_data["path"]
             self._create_file(path, file_data["content"], file_data["perms"])
 
         executor = concurrent.futures.ThreadPoolExecutor(self.thread_pool_size)
-        futures = []
+        pending: set = set()
+        max_pending = 2 * self.thread_pool_size
+        files = []
+
+        def submit(fn, file_data: Dict[str, Any]) -> None:
+            # Backpressure: cap the number of in-flight tasks so fetched
+            # contents are written out and freed as the build progresses,
+            # instead of all staying resident until the final wait.
+            if len(pending) >= max_pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                pending.difference_update(done)
+            pending.add(executor.submit(fn, file_data))
 
         os.makedirs(self.root, exist_ok=True)
+        dir_paths: List[bytes] = []
         queue = collections.deque([(b"", self.dir_id)])
         while queue:
             path, dir_id = queue.popleft()
             dir_entries = self.storage.directory_ls(dir_id)
             for dir_entry in dir_entries:
-                dir_entry["path"] = os.path.join(path, dir_entry["name"])
+                name = dir_entry["name"]
+                dir_entry["path"] = path + b"/" + name if path else name
                 match dir_entry["type"]:
                     case "dir":
-                        self._create_tree(dir_entry)
+                        dir_paths.append(dir_entry["path"])
                         queue.append((dir_entry["path"], dir_entry["target"]))
                     case "rev":
-                        self._create_revision(dir_entry)
+                        # Submodules are checked out as empty directories,
+                        # created with the rest of the tree below.
+                        dir_paths.append(dir_entry["path"])
                     case "file":
-                        futures.append(executor.submit(file_fetcher, dir_entry))
+                        files.append(dir_entry)
                     case _:
                         raise ValueError(
                             f"Unsupported directory entry type {dir_entry['type']} for "
                             f"{dir_entry['name']:r} in directory swh:1:dir:{dir_id.hex()}"
                         )
 
-        concurrent.futures.wait(futures)
+        self._create_tree(dir_paths)
 
-    def _create_tree(self, directory: Dict[str, Any]) -> None:
-        """Create a directory tree from root for the given path."""
-        os.makedirs(os.path.join(self.root, directory["path"]), exist_ok=True)
+        if self.objstorage is not None:
+            # Fetch the contents in large batches in this thread, so only the
+            # disk writes go through the executor.
+            for file_data in get_filtered_files_content(
+                self.storage, files, self.objstorage
+            ):
+                submit(file_writer, file_data)
+        else:
+            # No batch API on this path: fetch each content from its own
+            # thread so the round-trips overlap.
+            for file_data in files:
+                submit(file_fetcher, file_data)
+
+        concurrent.futures.wait(pending)
 
-    def _create_revision(self, rev_data: Dict[str, Any]) -> None:
-        """Create the revision in the tree as a broken symlink to the target
-        identifier."""
-        os.makedirs(os.path.join(self.root, rev_data["path"]), exist_ok=True)
+    def _create_tree(self, dir_paths: List[bytes]) -> None:
+        """Create the directory tree for the given repo-relative paths.
+
+        os.makedirs creates missing ancestors, so after sorting only the
+        paths that are not a prefix of their successor need a call of their
+        own: interior directories come for free, instead of costing a stat
+        walk over their ancestors each.
+        """
+        prefix = self._root_prefix
+        dir_paths.sort()
+        last = len(dir_paths) - 1
+        for i, path in enumerate(dir_paths):
+            if i == last or not dir_paths[i + 1].startswith(path + b"/"):
+                os.makedirs(prefix + path, exist_ok=True)
 
     def _create_file(
         self, path: bytes, content: bytes, mode: int = DentryPerms.content
@@ -151,6 +244,27 @@ class DirectoryBuilder:
         if perms == DentryPerms.symlink:
             os.symlink(content, path)
         else:
-            with open(path, "wb") as f:
-                f.write(content)
-            os.chmod(path, perms.value)
+            # Write through the file descriptor directly: the buffered file
+            # object and the separate path-based chmod add per-file overhead
+            # that matters when restoring thousands of small files.
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, perms.value)
+            try:
+                if len(content) >= FALLOCATE_MIN_SIZE and hasattr(
+                    os, "posix_fallocate"
+                ):
+                    # Preallocate the extents of large contents in one go,
+                    # instead of letting the filesystem grow the file write
+                    # by write.
+                    try:
+                        os.posix_fallocate(fd, 0, len(content))
+                    except OSError:
+                        # Not supported by every filesystem (tmpfs, NFS...).
+                        pass
+                view = memoryview(content)
+                while view:
+                    view = view[os.write(fd, view) :]
+                # set the exact permissions, whatever the umask masked off
+                # at creation time
+                os.fchmod(fd, perms.value)
+            finally:
+                os.close(fd)